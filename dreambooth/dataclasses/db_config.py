@@ -117,6 +117,7 @@ class DreamboothConfig(BaseModel):
     dynamic_img_norm: bool = False
     tenc_weight_decay: float = 0.01
     tenc_grad_clip_norm: float = 0.00
+    tf32: bool = False
     tomesd: float = 0
     train_batch_size: int = 1
     train_imagic: bool = False
@@ -307,10 +308,7 @@ class DreamboothConfig(BaseModel):
         Reload self from file
 
         """
-        models_path = shared.dreambooth_models_path
-        if models_path == "" or models_path is None:
-            models_path = os.path.join(shared.models_path, "dreambooth")
-        config_file = os.path.join(models_path, self.model_name, "db_config.json")
+        config_file = get_config_file(self.model_name)
         try:
             with open(config_file, 'r') as openfile:
                 config_dict = json.load(openfile)
@@ -482,6 +480,25 @@ def save_config(*args):
     config.save()
 
 
+def get_config_file(model_name, model_dir=None):
+    """
+    Resolve the path to a model's db_config.json
+    Args:
+        model_name: The model to look up
+        model_dir: If specified, override the default model directory
+
+    Returns: str
+
+    """
+    if model_dir:
+        models_path = model_dir
+    else:
+        models_path = shared.dreambooth_models_path
+        if models_path == "" or models_path is None:
+            models_path = os.path.join(shared.models_path, "dreambooth")
+    return os.path.join(models_path, model_name, "db_config.json")
+
+
 def from_file(model_name, model_dir=None):
     """
     Load config data from UI
@@ -500,13 +517,8 @@ def from_file(model_name, model_dir=None):
 
     #model_name = sanitize_name(model_name)
     if model_dir:
-        models_path = model_dir
-        shared.dreambooth_models_path = models_path
-    else:
-        models_path = shared.dreambooth_models_path
-        if models_path == "" or models_path is None:
-            models_path = os.path.join(shared.models_path, "dreambooth")
-    config_file = os.path.join(models_path, model_name, "db_config.json")
+        shared.dreambooth_models_path = model_dir
+    config_file = get_config_file(model_name, model_dir)
     try:
         with open(config_file, 'r') as openfile:
             config_dict = json.load(openfile)
@@ -160,6 +160,19 @@ def set_seed(deterministic: bool):
         torch.backends.cudnn.deterministic = False
 
 
+def set_tf32(matmul: bool, cudnn: bool = None):
+    """
+    Toggle the TF32 matmul/conv paths, returning the previous values so they can be restored
+    with set_tf32(*previous). cudnn follows matmul if not given.
+    """
+    if cudnn is None:
+        cudnn = matmul
+    previous = (torch.backends.cuda.matmul.allow_tf32, torch.backends.cudnn.allow_tf32)
+    torch.backends.cuda.matmul.allow_tf32 = matmul
+    torch.backends.cudnn.allow_tf32 = cudnn
+    return previous
+
+
 to_delete = []
 
 
@@ -237,6 +250,8 @@ def main(class_gen_method: str = "Native Diffusers", user: str = None) -> TrainR
     result = TrainResult
     result.config = args
     set_seed(args.deterministic)
+    # Let Ampere+ tensor cores run whatever stays in fp32 outside autocast, only while training.
+    previous_tf32 = set_tf32(True) if args.tf32 else None
 
     @find_executable_batch_size(
         starting_batch_size=args.train_batch_size,
@@ -1878,4 +1893,8 @@ def main(class_gen_method: str = "Native Diffusers", user: str = None) -> TrainR
             stop_profiler(profiler)
             return result
 
-    return inner_loop()
+    try:
+        return inner_loop()
+    finally:
+        if previous_tf32 is not None:
+            set_tf32(*previous_tf32)
@@ -1,3 +1,5 @@
+import copy
+import functools
 import gc
 import glob
 import importlib
@@ -8,8 +10,9 @@ import math
 import os
 import random
 import sys
-import traceback
-from collections import OrderedDict
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import gradio
 import torch
@@ -20,7 +23,7 @@ from torch.optim import AdamW
 
 from dreambooth import shared
 from dreambooth.dataclasses import db_config
-from dreambooth.dataclasses.db_config import from_file, sanitize_name
+from dreambooth.dataclasses.db_config import from_file, get_config_file, sanitize_name
 from dreambooth.dataclasses.prompt_data import PromptData
 from dreambooth.dataset.bucket_sampler import BucketSampler
 from dreambooth.dataset.class_dataset import ClassDataset
@@ -30,6 +33,7 @@ from dreambooth.shared import status, run
 from dreambooth.utils.gen_utils import generate_dataset, generate_classifiers
 from dreambooth.utils.image_utils import (
     get_images,
+    list_features,
     db_save_image,
     make_bucket_resolutions,
     get_dim,
@@ -39,6 +43,7 @@ from dreambooth.utils.image_utils import (
 from dreambooth.utils.model_utils import (
     unload_system_models,
     reload_system_models,
+    get_system_models_vram,
     get_lora_models,
     get_checkpoint_match,
     get_model_snapshots,
@@ -55,6 +60,36 @@ logger.addHandler(console)
 logger.setLevel(logging.DEBUG)
 dl.set_verbosity_error()
 
+_lora_cache = {"t": 0.0, "v": None}
+
+
+@functools.lru_cache(maxsize=8)
+def _load_config_cached(model_dir, config_file, stamp):
+    # config_file and stamp are only part of the cache key, so a moved or changed config is re-read.
+    return from_file(model_dir)
+
+
+def _from_file(model_dir):
+    """
+    Load a model config, reusing the parsed result while db_config.json is unchanged.
+    A copy is returned so callers can't mutate the cached object.
+    """
+    if isinstance(model_dir, list) and len(model_dir) > 0:
+        model_dir = model_dir[0]
+    if model_dir == "" or model_dir is None:
+        return None
+    config_file = get_config_file(model_dir)
+    try:
+        st = os.stat(config_file)
+    except OSError:
+        return from_file(model_dir)
+    # Size as well as mtime, coarse timestamps (SMB/FAT) can't tell apart two saves in one tick.
+    config = _load_config_cached(model_dir, config_file, (st.st_mtime_ns, st.st_size))
+    if config is not None:
+        config = copy.deepcopy(config)
+        shared.db_model_config = config
+    return config
+
 
 def gr_update(default=None, **kwargs):
     try:
@@ -65,6 +100,57 @@ def gr_update(default=None, **kwargs):
         return kwargs["value"] if "value" in kwargs else default
 
 
+def _get_lora_models_cached(config=None, ttl=2.0, refresh=False):
+    """
+    Return get_lora_models(), re-scanning the Lora dir at most once every ttl seconds.
+    Pass refresh=True after something may have written new lora files.
+    """
+    now = time.monotonic()
+    if refresh or _lora_cache["v"] is None or now - _lora_cache["t"] > ttl:
+        _lora_cache["v"] = get_lora_models(config)
+        _lora_cache["t"] = now
+    return list(_lora_cache["v"])
+
+
+def _exists_any(*paths):
+    """
+    Check several paths at once, so remote storage costs one round-trip instead of one per path.
+    Returns a dict of path -> exists. Empty paths map to False.
+    """
+    paths = [path for path in paths if path]
+    if not paths:
+        return defaultdict(bool)
+    with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+        return defaultdict(bool, zip(paths, executor.map(os.path.exists, paths)))
+
+
+@functools.lru_cache(maxsize=1)
+def _image_exts():
+    # Same extensions get_images()/is_image() accept, pilinfo() is too slow to run per file.
+    return frozenset(list_features())
+
+
+def _count_images(image_path):
+    """
+    Count the images under image_path (recursively) without building a list of paths.
+    Matches what get_images() would return for the same directory.
+    """
+    count = 0
+    if not image_path or not os.path.exists(image_path):
+        return count
+    image_exts = _image_exts()
+    with os.scandir(image_path) as entries:
+        for entry in entries:
+            # Mac creates metadata files for every image with name `._{filename}`, so we skip it
+            if sys.platform == "darwin" and entry.name.startswith("._"):
+                continue
+            if entry.is_dir():
+                count += _count_images(entry.path)
+            elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in image_exts:
+                count += 1
+    return count
+
+
 def training_wizard_person(model_dir):
     return training_wizard(model_dir, is_person=True)
 
@@ -88,9 +174,11 @@ def training_wizard(model_dir, is_person=False):
     else:
         class_count = 0
 
-    w_status = f"Wizard results:"
-    w_status += f"<br>Num Epochs: {step_mult}"
-    w_status += f"<br>Num instance images per class image: {class_count}"
+    w_status = "<br>".join((
+        "Wizard results:",
+        f"Num Epochs: {step_mult}",
+        f"Num instance images per class image: {class_count}",
+    ))
 
     print(w_status)
 
@@ -156,6 +244,58 @@ def closest_factors_to_sqrt(n):
     return closest_factors
 
 
+@functools.lru_cache(maxsize=1)
+def _ampere_or_newer():
+    try:
+        return torch.cuda.is_available() and torch.cuda.get_device_capability(0)[0] >= 8
+    except:
+        return False
+
+
+def _bf16_ok():
+    # bf16 has fp32's exponent range, so Ampere+ can skip fp16 loss scaling entirely.
+    # fp16 is left for Turing/Volta, where bf16 is only emulated.
+    return _ampere_or_newer()
+
+
+def _vram_gb():
+    """
+    Return (free, total) VRAM in GB for device 0, where free is what training will get.
+    Not cached, free memory depends on whatever else is loaded on the GPU right now.
+    """
+    free, total = torch.cuda.mem_get_info(0)
+    # Training starts with unload_system_models(), which moves the webui checkpoint off the GPU
+    # and empties PyTorch's cache, so count both as available.
+    free += torch.cuda.memory_reserved(0) - torch.cuda.memory_allocated(0)
+    free += get_system_models_vram()
+    free = min(free, total)
+    # Round down so the thresholds keep their headroom
+    return math.floor(free / 1073741824), math.ceil(total / 1073741824)
+
+
+@functools.lru_cache(maxsize=1)
+def _has_xformers():
+    try:
+        from diffusers.utils.import_utils import is_xformers_available
+
+        return is_xformers_available()
+    except:
+        return False
+
+
+@functools.lru_cache(maxsize=1)
+def _has_flash_sdp():
+    try:
+        return (
+            torch.cuda.is_available()
+            and torch.cuda.get_device_capability(0)[0] >= 8
+            and hasattr(torch.nn.functional, "scaled_dot_product_attention")
+            and torch.backends.cuda.flash_sdp_enabled()
+        )
+    except:
+        return False
+
+
 def performance_wizard(model_name):
     """
     Calculate performance settings based on available resources.
@@ -164,16 +304,17 @@ def performance_wizard(model_name):
     optimizer: Optimizer
     gradient_checkpointing: Whether to use gradient checkpointing or not.
     gradient_accumulation_steps: Number of steps to use. Set to batch size.
-    mixed_precision: Mixed precision to use. BF16 will be selected if available.
+    mixed_precision: Mixed precision to use. BF16 on Ampere or newer, FP16 otherwise.
     not_cache_latents: Latent caching.
     sample_batch_size: Batch size to use when creating class images.
     train_batch_size: Batch size to use when training.
     stop_text_encoder: Whether to train text encoder or not.
     use_lora: Train using LORA. Better than "use CPU".
     use_ema: Train using EMA.
+    tf32: Use TF32 matmuls while training. Only on Ampere or newer.
     msg: Stuff to show in the UI
     """
-    attention = "flash_attention"
+    attention = "default"
     optimizer = "8bit AdamW"
     gradient_checkpointing = False
     gradient_accumulation_steps = 1
@@ -184,23 +325,28 @@ def performance_wizard(model_name):
     stop_text_encoder = 0
     use_lora = False
     use_ema = False
+    tf32 = _ampere_or_newer()
     config = None
     if model_name == "" or model_name is None:
         print("Can't load config, specify a model name!")
     else:
-        config = from_file(model_name)
+        config = _from_file(model_name)
     save_samples_every = gr_update(config.save_preview_every)
     save_weights_every = gr_update(config.save_embedding_every)
 
-    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+    if _bf16_ok():
         mixed_precision = "bf16"
     if config is not None:
         total_images = 0
-        for concept in config.concepts():
-            idd = concept.instance_data_dir
-            if idd and os.path.exists(idd):
-                images = get_images(idd)
-                total_images += len(images)
+        concepts = config.concepts()
+        if len(concepts):
+            # Directory walks are I/O bound, so count concepts in parallel.
+            # Capped, a concepts file can list any number of entries.
+            with ThreadPoolExecutor(max_workers=min(len(concepts), 8)) as executor:
+                counts_list = list(executor.map(
+                    _count_images, [concept.instance_data_dir for concept in concepts]
+                ))
+            total_images = sum(counts_list)
         print(f"Total images: {total_images}")
         if total_images != 0:
             best_factors = closest_factors_to_sqrt(total_images)
@@ -225,43 +371,50 @@ def performance_wizard(model_name):
                 train_batch_size = largest_factor
                 gradient_accumulation_steps = smallest_factor
 
-    has_xformers = False
-    try:
-        from diffusers.utils.import_utils import is_xformers_available
-
-        has_xformers = is_xformers_available()
-    except:
-        pass
-    if has_xformers:
+    # "default" leaves diffusers' own attention processor in place, which uses torch's
+    # scaled_dot_product_attention and dispatches to FlashAttention-2 kernels on Ampere and newer.
+    memory_efficient_attention = _has_flash_sdp()
+    if not memory_efficient_attention and _has_xformers():
         attention = "xformers"
-    try:
-        stop_text_encoder = 0.75
-        t = torch.cuda.get_device_properties(0).total_memory
-        gb = math.ceil(t / 1073741824)
-        print(f"Total VRAM: {gb}")
-        if gb >= 24:
-            sample_batch_size = 4
-            use_ema = True
-            if attention != "xformers":
-                attention = "no"
-                train_batch_size = 1
+        memory_efficient_attention = True
+    stop_text_encoder = 0.75
+    if not torch.cuda.is_available():
+        msg = "CUDA is not available, using default training params:"
+    else:
+        try:
+            gb, total_gb = _vram_gb()
+            print(f"Free VRAM: {gb} of {total_gb}")
+            # Thresholds sit ~2GB under the card sizes to leave headroom for transient allocations
+            if gb >= 22:
+                sample_batch_size = 4
+                use_ema = True
+                if not memory_efficient_attention:
+                    train_batch_size = 1
+                    gradient_accumulation_steps = 1
+            # Below 22GB accumulation stays at 1, with mixed precision it can cost several GB of extra VRAM
+            if 22 > gb >= 14:
+                use_ema = True
+                gradient_checkpointing = True
                 gradient_accumulation_steps = 1
-        if 24 > gb >= 16:
-            use_ema = True
-        if 16 > gb >= 12:
-            use_ema = False
-            cache_latents = False
-            gradient_accumulation_steps = 1
-            train_batch_size = 1
-        if gb < 12:
-            use_lora = True
-            save_samples_every = gr_update(value=0)
-            save_weights_every = gr_update(value=0)
-
-        msg = f"Calculated training params based on {gb}GB of VRAM:"
-    except Exception as e:
-        msg = f"An exception occurred calculating performance values: {e}"
-        pass
+                train_batch_size = 2
+            if 14 > gb >= 10:
+                # Checkpointing costs some compute but frees enough memory for a bigger batch than EMA would
+                use_ema = False
+                use_lora = True
+                cache_latents = False
+                gradient_checkpointing = True
+                gradient_accumulation_steps = 1
+                train_batch_size = 2
+            if gb < 10:
+                use_lora = True
+                gradient_checkpointing = True
+                save_samples_every = gr_update(value=0)
+                save_weights_every = gr_update(value=0)
+
+            msg = f"Calculated training params based on {gb}GB of free VRAM ({total_gb}GB total):"
+        except Exception as e:
+            msg = f"An exception occurred calculating performance values: {e}"
+            pass
 
     log_dict = {
         "Attention": attention,
@@ -275,6 +428,7 @@ def performance_wizard(model_name):
         "Optimizer": optimizer,
         "EMA": use_ema,
         "LORA": use_lora,
+        "TF32": tf32,
     }
     for key in log_dict:
         msg += f"<br>{key}: {log_dict[key]}"
@@ -290,6 +444,7 @@ def performance_wizard(model_name):
         stop_text_encoder,
         use_lora,
         use_ema,
+        tf32,
         save_samples_every,
         save_weights_every,
         msg,
@@ -417,7 +572,7 @@ def generate_samples(
     def sample_loop(train_batch_size):
         if model_name is None or model_name == "":
             return "Please select a model."
-        config = from_file(model_name)
+        config = _from_file(model_name)
         source_model = None
 
         if class_gen_method == "A1111 txt2img (Euler a)":
@@ -478,7 +633,7 @@ def generate_samples(
                 config=config,
                 class_gen_method=class_gen_method,
                 lora_model=config.lora_model_name,
-                batch_size=batch_size,
+                batch_size=train_batch_size,
                 lora_unet_rank=config.lora_unet_rank,
                 lora_txt_rank=config.lora_txt_rank,
                 source_checkpoint=source_model,
@@ -509,21 +664,16 @@ def generate_samples(
             while len(images) < num_samples and not shared.status.interrupted:
                 samples_needed = num_samples - len(images)
                 to_gen = min(samples_needed, train_batch_size)
-                to_generate = []
-                batch_images = []
-                batch_prompts = []
                 print(f"Looping: {len(images)} {to_gen}")
 
-                for i in range(to_gen):
-                    sel = prompt_data[sample_index]
-                    to_generate.append(sel)
-                    batch_prompts.append(sel.prompt)
-                    sample_index += 1
+                to_generate = prompt_data[sample_index:sample_index + to_gen]
+                if not to_generate:
+                    # Every prompt was used but the pipeline came back short, don't retry empty batches
+                    break
+                batch_prompts = [sel.prompt for sel in to_generate]
+                sample_index += to_gen
                 out_images = img_builder.generate_images(to_generate, pbar)
-                for img, pd in zip(out_images, to_generate):
-                    image_name = db_save_image(img, pd)
-                    batch_images.append(image_name)
-                images.extend(batch_images)
+                images.extend([db_save_image(img, pd) for img, pd in zip(out_images, to_generate)])
                 prompts_out.extend(batch_prompts)
                 shared.status.current_image = images
                 shared.status.sample_prompts = batch_prompts
@@ -535,8 +685,7 @@ def generate_samples(
                 print("OOM detected, decreasing batch size.")
                 raise
             else:
-                print(msg)
-                traceback.print_exc()
+                logger.exception(msg)
 
         try:
             swap_class = get_script_class()
@@ -572,8 +721,7 @@ def generate_samples(
             #     foo = swap_class.run(p, *param_list)
             #     print("DO FACE SWAP HERE")
         except Exception as p:
-            print(f"Exception face swapping: {p}")
-            traceback.print_exc()
+            logger.exception(f"Exception face swapping: {p}")
             pass
 
         reload_system_models()
@@ -585,7 +733,7 @@ def generate_samples(
 
 
 def load_params(model_dir):
-    data = from_file(model_dir)
+    data = _from_file(model_dir)
     ui_dict = {}
     msg = ""
     if data is None:
@@ -595,24 +743,18 @@ def load_params(model_dir):
         print("Can't load config!")
         msg = "Please check your model config."
     else:
-        for key in data.__dict__:
-            value = data.__dict__[key]
+        for key, value in vars(data).items():
             if key == "pretrained_model_name_or_path":
                 key = "model_path"
             ui_dict[f"db_{key}"] = value
-            msg = "Loaded config."
+        msg = "Loaded config."
 
     ui_concept_list = data.concepts(4)
-    c_idx = 1
-    for ui_concept in ui_concept_list:
-        for key in sorted(ui_concept.__dict__):
-            ui_dict[f"c{c_idx}_{key}"] = ui_concept.__dict__[key]
-        c_idx += 1
+    for c_idx, ui_concept in enumerate(ui_concept_list, start=1):
+        for key, value in vars(ui_concept).items():
+            ui_dict[f"c{c_idx}_{key}"] = value
     ui_dict["db_status"] = msg
-    ui_keys = db_config.ui_keys
-    output = []
-    for key in ui_keys:
-        output.append(ui_dict[key] if key in ui_dict else None)
+    output = [ui_dict.get(key) for key in db_config.ui_keys]
 
     return output
 
@@ -635,7 +777,7 @@ def load_model_params(model_name):
     if isinstance(model_name, list) and len(model_name) > 0:
         model_name = model_name[0]
 
-    config = from_file(model_name)
+    config = _from_file(model_name)
     db_model_snapshots = gr_update(choices=[], value="")
     if config is None:
         print("Can't load config!")
@@ -646,7 +788,7 @@ def load_model_params(model_name):
         snap_selection = config.revision if str(config.revision) in snaps else ""
         db_model_snapshots = gr_update(choices=snaps, value=snap_selection)
 
-        loras = get_lora_models(config)
+        loras = _get_lora_models_cached(config)
         db_lora_models = gr_update(choices=loras)
         msg = f"Selected model: '{model_name}'."
         src_name = os.path.basename(config.src)
@@ -667,6 +809,19 @@ def load_model_params(model_name):
         )
 
 
+@functools.lru_cache(maxsize=1)
+def _train_mod():
+    # Deferred until training is first requested, it pulls in most of diffusers/transformers.
+    from dreambooth import train_dreambooth  # noqa
+    return train_dreambooth
+
+
+@functools.lru_cache(maxsize=1)
+def _imagic_mod():
+    from dreambooth import train_imagic  # noqa
+    return train_imagic
+
+
 def start_training(model_dir: str, class_gen_method: str = "Native Diffusers"):
     """
 
@@ -684,7 +839,7 @@ def start_training(model_dir: str, class_gen_method: str = "Native Diffusers"):
         msg = "Create or select a model first."
         lora_model_name = gr_update(visible=True)
         return lora_model_name, 0, 0, [], msg
-    config = from_file(model_dir)
+    config = _from_file(model_dir)
     # Clear pretrained VAE Name if applicable
     if config.pretrained_vae_name_or_path == "":
         config.pretrained_vae_name_or_path = None
@@ -695,10 +850,13 @@ def start_training(model_dir: str, class_gen_method: str = "Native Diffusers"):
             msg = "Using xformers, please set mixed precision to 'fp16' or 'bf16' to continue."
     if not len(config.concepts()):
         msg = "Please check your dataset directories."
-    if not os.path.exists(config.get_pretrained_model_name_or_path()):
+    model_path = config.get_pretrained_model_name_or_path()
+    vae_path = config.pretrained_vae_name_or_path
+    exists = _exists_any(model_path, vae_path)
+    if not exists[model_path]:
         msg = "Invalid training data directory."
-    if config.pretrained_vae_name_or_path:
-        if not os.path.exists(config.pretrained_vae_name_or_path):
+    if vae_path:
+        if not exists[vae_path]:
             msg = "Invalid Pretrained VAE Path."
     if config.resolution <= 0:
         msg = "Invalid resolution."
@@ -719,23 +877,17 @@ def start_training(model_dir: str, class_gen_method: str = "Native Diffusers"):
         if config.train_imagic:
             status.textinfo = "Initializing imagic training..."
             print(status.textinfo)
-            try:
-                from dreambooth.train_imagic import train_imagic  # noqa
-            except:
-                from dreambooth.train_imagic import train_imagic  # noqa
-
-            result = train_imagic(config)
+            result = _imagic_mod().train_imagic(config)
         else:
             status.textinfo = "Initializing dreambooth training..."
             print(status.textinfo)
-            try:
-                from dreambooth.train_dreambooth import main  # noqa
-            except:
-                from dreambooth.train_dreambooth import main  # noqa
-            result = main(class_gen_method=class_gen_method)
+            result = _train_mod().main(class_gen_method=class_gen_method)
+        # Full collection first, cycles (compiled unet, optimizer/accelerator graphs) can still hold
+        # CUDA tensors that empty_cache() would otherwise be unable to hand back to the driver.
+        gc.collect()
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
-        gc.collect()
+            torch.cuda.ipc_collect()
         config = result.config
         images = result.samples
         if config.revision != total_steps:
@@ -754,7 +906,7 @@ def start_training(model_dir: str, class_gen_method: str = "Native Diffusers"):
         )
     except Exception as e:
         res = f"Exception training model: '{e}'."
-        traceback.print_exc()
+        logger.exception(res)
         pass
 
     status.end()
@@ -763,8 +915,9 @@ def start_training(model_dir: str, class_gen_method: str = "Native Diffusers"):
     lora_model_name = ""
     if config.lora_model_name:
         lora_model_name = f"{config.model_name}_{total_steps}.pt"
-    dirs = get_lora_models()
-    lora_model_name = gr_update(choices=sorted(dirs), value=lora_model_name)
+    # Training may have written new lora weights, so skip the cache here
+    dirs = _get_lora_models_cached(config, refresh=True)
+    lora_model_name = gr_update(choices=dirs, value=lora_model_name)
     return lora_model_name, total_steps, config.epoch, images, res
 
 
@@ -818,7 +971,7 @@ def ui_classifiers(model_name: str, class_gen_method: str = "Native Diffusers"):
         print("Invalid model name.")
         msg = "Create or select a model first."
         return msg
-    config = from_file(model_name)
+    config = _from_file(model_name)
     status.textinfo = "Generating class images..."
     # Clear pretrained VAE Name if applicable
     if config.pretrained_vae_name_or_path == "":
@@ -830,10 +983,13 @@ def ui_classifiers(model_name: str, class_gen_method: str = "Native Diffusers"):
             msg = "Using xformers, please set mixed precision to 'fp16' or 'bf16' to continue."
     if not len(config.concepts()):
         msg = "Please check your dataset directories."
-    if not os.path.exists(config.pretrained_model_name_or_path):
+    model_path = config.pretrained_model_name_or_path
+    vae_path = config.pretrained_vae_name_or_path
+    exists = _exists_any(model_path, vae_path)
+    if not exists[model_path]:
         msg = "Invalid training data directory."
-    if config.pretrained_vae_name_or_path:
-        if not os.path.exists(config.pretrained_vae_name_or_path):
+    if vae_path:
+        if not exists[vae_path]:
             msg = "Invalid Pretrained VAE Path."
     if config.resolution <= 0:
         msg = "Invalid resolution."
@@ -851,7 +1007,7 @@ def ui_classifiers(model_name: str, class_gen_method: str = "Native Diffusers"):
         msg = f"Generated {count} class images."
     except Exception as e:
         msg = f"Exception generating concepts: {str(e)}"
-        traceback.print_exc()
+        logger.exception(msg)
         status.job_no = status.job_count
         status.textinfo = msg
     return images, msg
@@ -1044,7 +1200,7 @@ def debug_buckets(model_name, num_epochs, batch_size):
     if model_name == "" or model_name is None:
         status.end()
         return "No model selected."
-    args = from_file(model_name)
+    args = _from_file(model_name)
     if args is None:
         status.end()
         return "Invalid config."
@@ -146,7 +146,7 @@ def get_lora_models(config: DreamboothConfig = None):
     if config is not None:
         lora_dir = os.path.join(shared.models_path, "Lora")
         if os.path.exists(lora_dir):
-            files = os.listdir(lora_dir)
+            files = sorted(os.listdir(lora_dir))
             for file in files:
                 if os.path.isfile(os.path.join(lora_dir, file)):
                     if ".safetensors" in file or ".pt" in file or ".ckpt" in file:
@@ -198,6 +198,21 @@ def unload_system_models():
         pass
 
 
+def get_system_models_vram() -> int:
+    """
+    Bytes of VRAM unload_system_models() would release by moving the webui checkpoint to the CPU.
+    """
+    try:
+        import modules.shared
+        sd_model = modules.shared.sd_model
+        if sd_model is None:
+            return 0
+        tensors = list(sd_model.parameters()) + list(sd_model.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors if t.is_cuda)
+    except:
+        return 0
+
+
 def reload_system_models():
     try:
         import modules.shared
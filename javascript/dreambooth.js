@@ -227,6 +227,7 @@ let db_titles = {
     "Extract EMA Weights": "If EMA weights are saved in a model, these will be extracted instead of the full Unet. Probably not necessary for training or fine-tuning.",
     "Freeze CLIP Normalization Layers": "Keep the normalization layers of CLIP frozen during training. Advanced usage, may increase model performance and editability.",
     "Full Mixed Precision": "Loads all possible nets in mixed precision. Saves memory potentially at the cost of accuracy",
+    "Use TF32 Matmul": "Run fp32 matmuls and convolutions on TF32 tensor cores while training. Faster on Ampere and newer GPUs, slightly lower precision.",
     "Generate Ckpt": "Generate a checkpoint at the current training level.",
     "Generate Class Images": "Create classification images using training settings without training.",
     "Generate Classification Images Using txt2img": "Use the source checkpoint and TXT2IMG to generate class images.",
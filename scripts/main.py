@@ -572,6 +572,9 @@ def on_ui_tabs():
                         db_full_mixed_precision = gr.Checkbox(
                             label="Full Mixed Precision", value=True
                         )
+                        db_tf32 = gr.Checkbox(
+                            label="Use TF32 Matmul", value=False
+                        )
                         db_attention = gr.Dropdown(
                             label="Memory Attention",
                             value=select_attention(),
@@ -1347,6 +1350,7 @@ def on_ui_tabs():
             db_weight_decay,
             db_tenc_weight_decay,
             db_tenc_grad_clip_norm,
+            db_tf32,
             db_min_snr_gamma,
             db_pad_tokens,
             db_strict_tokens,
@@ -1524,6 +1528,7 @@ def on_ui_tabs():
             db_dynamic_img_norm,
             db_tenc_grad_clip_norm,
             db_tenc_weight_decay,
+            db_tf32,
             db_train_batch_size,
             db_train_imagic,
             db_train_unet,
@@ -1835,6 +1840,7 @@ def on_ui_tabs():
                 db_stop_text_encoder,
                 db_use_lora,
                 db_use_ema,
+                db_tf32,
                 db_save_preview_every,
                 db_save_embedding_every,
                 db_status,